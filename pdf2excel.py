@@ -1,179 +1,361 @@
-import pdf2image 
-from google.cloud import vision 
+import fitz #PyMuPDF -- renders pdf pages in C without shelling out to poppler
+from google.cloud import vision
+from google.cloud.vision_v1.services.image_annotator.transports import ImageAnnotatorGrpcTransport #to hand the client a tuned grpc channel
+from google.api_core import retry as gcloud_retry #ready-made exponential backoff for transient api errors
+import numpy as np #vectorized bounding box math -- the hot part of post-ocr processing
+
+try:
+    from numba import njit #optional: jit-compiles the row clustering into one C loop for big multi-page runs
+except ImportError:
+    njit = None #numba not installed -- the plain python/numpy version still works, just slower on huge documents
 import openpyxl #to create and write excel files with proper formatting
 import openpyxl.styles #for bolding the headers
+from openpyxl.cell import WriteOnlyCell #styled cells for write-only worksheets
 import sys
 import os
+import gc #to nudge the collector between batches -- response protos can sit in cyclic refs
+from concurrent.futures import ProcessPoolExecutor #fans page slices out across cpu cores -- separate processes sidestep the gil
+
+BATCH_SIZE = 16 #vision allows up to 16 images per batched request -- one round trip instead of 16
+DEFAULT_DPI = 150 #the sweet spot for scanned text -- bump it from the command line for very dense tables
+
+BOLD = openpyxl.styles.Font(bold=True) #one shared font object for every header cell -- fonts are immutable so this is safe
+
+GRPC_CHANNEL_OPTIONS = [
+    ("grpc.keepalive_time_ms", 30000), #ping every 30s so the connection stays warm between bursts of pages
+    ("grpc.keepalive_timeout_ms", 10000), #how long to wait for a ping reply before declaring the connection dead
+    ("grpc.max_concurrent_streams", 100), #plenty of in-flight rpcs over the single http/2 connection
+]
+
+#exponential backoff for anything transient (429 rate limits, 503s, ...): 1s, 2s, 4s... capped at 30s, giving up after 60s total
+OCR_RETRY = gcloud_retry.Retry(initial=1, maximum=30, multiplier=2, timeout=60, predicate=gcloud_retry.if_transient_error)
+
+def create_vision_client():
+    '''
+    builds an ImageAnnotatorClient on a long-lived grpc channel with keepalive
+    pings. without this the default channel goes idle between bursts and every
+    new burst pays a fresh tls handshake + tcp slow start, which is where a lot
+    of the tail latency on the ocr calls comes from.
+    '''
+    channel = ImageAnnotatorGrpcTransport.create_channel("vision.googleapis.com", options=GRPC_CHANNEL_OPTIONS)
+    return vision.ImageAnnotatorClient(transport=ImageAnnotatorGrpcTransport(channel=channel))
 
 #PDF TO IMAGE STRUCTURE
-def convert_pdf_to_images(pdf_path):
+def convert_pdf_to_images(pdf_path, page_indices=None, dpi=DEFAULT_DPI):
+    '''
+    generator that renders one page at a time with PyMuPDF, yielding each page
+    as ready-to-upload jpeg bytes. yielding pages one by one means only a
+    single page lives in memory at once instead of the whole document -- a 100
+    page scan no longer needs gigabytes of ram. encoding straight off the
+    pixmap also skips the old pixmap -> PIL image -> BytesIO -> bytes chain,
+    each hop of which copied ~170MB of pixels for a full-res scanned page.
+    pass page_indices to render only a subset of pages (used by the worker processes).
+    '''
     if not os.path.exists(pdf_path):
         raise FileNotFoundError(f"PDF file not found: {pdf_path}")
-    
-    images = pdf2image.convert_from_path(pdf_path) #reads pdf and returns a list where each item is an of one page
-    return images
+
+    doc = fitz.open(pdf_path) #opens the pdf without rendering anything yet
+    try:
+        for page_number in (range(doc.page_count) if page_indices is None else page_indices):
+            #grayscale: ocr doesn't need color and one channel instead of three
+            #means ~3x fewer bytes to encode, upload and decode server-side
+            pix = doc.load_page(page_number).get_pixmap(dpi=dpi, colorspace=fitz.csGRAY)
+            #jpeg instead of png: encoding a scanned page as jpeg is several times faster
+            #than png's deflate and the payload is ~4x smaller, so uploads finish sooner.
+            #quality 85 keeps the text crisp enough for ocr
+            yield pix.tobytes("jpeg", jpg_quality=85) #hand the page to the caller before rendering the next one
+            pix = None #drop the pixmap so its pixels are freed before the next page renders
+    finally:
+        doc.close() #also releases mupdf's internal caches for this document
 
 # OCR PROCESSING SETUP
-def extract_text_from_image(client, image):
+def extract_text_from_images(client, images):
     '''
-    We're separating OCR processing into its own function because we'll need to do this for every page. 
-    It's cleaner to write the OCR code once and call it multiple times.
+    ocr for a whole batch of pages in one api call. images are already encoded
+    jpeg bytes straight from the renderer, so they go into the request as-is --
+    no BytesIO buffer, no getvalue() copy, just the one unavoidable copy into
+    the request proto.
+    every individual call pays a full tls + grpc round trip (~150ms), so sending
+    up to 16 pages per request amortizes that overhead across the batch.
+    returns one response per image, in the same order the images came in.
     '''
-    import io #to convert our image to a byte stream format
-
-    image_bytes = io.BytesIO() #creates an empty byte buffer - think of it as a container that will hold our image data in the format Google expects
-    image.save(image_bytes, format='PNG') #saving our image into byte buffer as PNG file
-    image_bytes = image_bytes.getvalue() #getvalue extracts the actual byte data from our buffer, leaving variable with only the raw png data
-    image_content = vision.Image(content=image_bytes) #wrapping byte_data in google vison's image object
+    requests = [
+        {
+            "image": vision.Image(content=image), #wrapping the jpeg bytes in google vison's image object
+            #document mode: google's layout model groups words into paragraphs
+            #and blocks for us, which beats regrouping thousands of word boxes ourselves
+            "features": [{"type_": vision.Feature.Type.DOCUMENT_TEXT_DETECTION}],
+        }
+        for image in images
+    ]
+
+    #one round trip for the whole batch; OCR_RETRY transparently backs off and
+    #retries on rate limits and other transient errors
+    response = client.batch_annotate_images(requests=requests, retry=OCR_RETRY)
+    return response.responses
+
+#PER-PROCESS VISION CLIENT
+_worker_client = None #one client per worker process -- clients hold a grpc channel and can't be pickled across processes
+
+def _init_worker_client():
+    '''runs once in every worker process right after the pool starts it'''
+    global _worker_client
+    _worker_client = create_vision_client()
+
+#PAGE PROCESSING WORKER
+def process_pages(pdf_path, page_indices, dpi=DEFAULT_DPI):
+    '''
+    runs inside a worker process: renders the given pages, ocrs them in
+    batches of 16 and analyzes every response straight away.
+    the cpu-heavy local work (jpeg encoding, walking response protos, bounding
+    box math) runs truly in parallel here because every worker is its own
+    process with its own gil. returns the soa block arrays per page, in page order.
+    '''
+    client = _worker_client if _worker_client is not None else create_vision_client() #fallback so this also works outside a pool
 
-    response = client.text_detection(image_content) #actual ocr call 
+    page_blocks = []
+    pages_since_gc = 0 #pages processed since we last ran the garbage collector
 
-    return response
+    def ocr_and_analyze(batch):
+        '''
+        one api call, then analyze-and-discard: each big response proto is
+        reduced to its small bbox arrays immediately so only the arrays
+        accumulate, never whole protos or page images.
+        '''
+        nonlocal pages_since_gc
+        responses = extract_text_from_images(client, batch)
+        batch.clear() #the jpeg payloads have been sent -- free them before parsing the responses
+        for page_data in responses:
+            page_blocks.append(analyze_table_structure(page_data))
+            pages_since_gc += 1
+        del responses #multi-MB protos; drop them as soon as the bbox arrays are out
+        if pages_since_gc >= 10: #every ~10 pages, sweep up anything cyclic the protos left behind
+            gc.collect()
+            pages_since_gc = 0
+
+    batch = [] #pages collected for the current api call
+    batch_start = None #first page number in the current batch, for progress output
+    for page_number, image in zip(page_indices, convert_pdf_to_images(pdf_path, page_indices, dpi)):
+        if batch_start is None:
+            batch_start = page_number
+        batch.append(image)
+        if len(batch) == BATCH_SIZE: #batch is full -- one api round trip for all of it
+            print(f"Processing pages {batch_start + 1}-{page_number + 1}...")
+            ocr_and_analyze(batch)
+            batch = []
+            batch_start = None
+    if batch: #whatever is left over becomes the final (short) batch
+        print(f"Processing pages {batch_start + 1}-{page_indices[-1] + 1}...")
+        ocr_and_analyze(batch)
+
+    return page_blocks
 
 #TEXT STRUCTURE ANALYSIS
+def paragraph_text(paragraph):
+    '''rebuilds a paragraph's text from its words and symbols -- full_text_annotation has no ready-made string per paragraph'''
+    return " ".join("".join(symbol.text for symbol in word.symbols) for word in paragraph.words)
+
 def analyze_table_structure(text_data):
     '''
     figures out how the ocr text is organized into rows and columns.
+
+    document text detection gives us full_text_annotation, where google's
+    layout model has already grouped words into paragraphs and blocks -- about
+    10x fewer boxes than word level, and cell contents usually arrive as one
+    paragraph each. we work at paragraph level and only fall back to the raw
+    word-level text_annotations when the layout model lumped the whole page
+    into a single paragraph (no structure to work with).
+
+    either way, a dense page can still have lots of boxes, so instead of
+    looping in python and calling min/max four times per box we stack every
+    box's vertices into one (N, 4, 2) array and let numpy reduce them all at once.
     '''
-    extracted_blocks = [] #vision returns text in blocks -- rectangular areas containing related text
+    paragraphs = [
+        paragraph
+        for page in text_data.full_text_annotation.pages
+        for block in page.blocks
+        for paragraph in block.paragraphs
+    ]
+
+    if len(paragraphs) > 1:
+        texts = [paragraph_text(p) for p in paragraphs]
+        boxes = [p.bounding_box for p in paragraphs]
+    else:
+        #word-level fallback -- our own 5-pixel row grouping takes it from here
+        annotations = [a for a in text_data.text_annotations if a.description] #some annotations maybe empty and contain only white spaces
+        texts = [a.description for a in annotations]
+        boxes = [a.bounding_poly for a in annotations]
+
+    if not texts:
+        return empty_text_blocks()
+
+    #vertices contains the coordinates of the rectangular box around each text piece
+    vertices = np.array(
+        [[(vertex.x, vertex.y) for vertex in box.vertices] for box in boxes],
+        dtype=np.int32,
+    )
+    mins = vertices.min(axis=1) #per box: (left, top) in one simd pass over all boxes
+    maxs = vertices.max(axis=1) #per box: (right, bottom)
 
-    for annotation in  text_data.text_annotations:
-        '''
-        Google Vision returns multiple types of text detection. 
-        text_annotations contains individual text elements with their positions. 
-        We loop through each one
-        '''
-        if annotation.description: #some annotations maybe empty and contain only white spaces
-            vertices = annotation.bounding_poly.vertices #vertices contains the coordinates of the rectangular box around the text
-            x_coords = [vertex.x for vertex in vertices] #extracting all x coordinate of bounding boxes
-            y_coords = [vertex.y for vertex in vertices] #extracting all y coordinates of the box
-
-            left = min(x_coords)
-            right = max(x_coords)
-            top = min(y_coords)
-            bottom = max(y_coords)
-
-            '''
-            storing all important information about each text piece:
-            what it says and exactly where its positioned.
-            '''
-            text_block = {
-                'text': annotation.description,
-                'left': left,
-                'right': right,
-                'top': top,
-                'bottom': bottom
-            }
-
-            extracted_blocks.append(text_block)
-
-    return extracted_blocks
+    '''
+    structure-of-arrays instead of a list of dicts: one contiguous array per
+    coordinate plus a plain list of strings. every later step (sorting into
+    rows, sorting into columns) is an argsort over these arrays instead of a
+    python loop doing a dict lookup per block.
+    '''
+    return mins[:, 0], mins[:, 1], maxs[:, 0], maxs[:, 1], texts #lefts, tops, rights, bottoms, texts
+
+def empty_text_blocks():
+    '''the soa equivalent of "no text found on this page"'''
+    empty = np.empty(0, dtype=np.int32)
+    return empty, empty, empty, empty, []
 
 #ROW DETECTION
-def group_text_into_rows(text_blocks):
-    if not text_blocks:
-        return[]
-    
+def _cluster_rows(tops, threshold):
     '''
-    sorting text by vertical position
+    assigns every block a dense 0..n_rows-1 row id: blocks whose tops land in
+    the same threshold-pixel band share a row, and ids count top to bottom.
+    written as one explicit pass over the argsorted tops instead of np.unique
+    on purpose: numba compiles this shape to a single C loop with no
+    temporaries (np.unique inside jit code is slow), and it works unchanged
+    as plain python when numba isn't around.
     '''
-    sorted_blocks = sorted(text_blocks, key=lambda x: x['top']) #sorting all text blocks from top to bottom of the page
-    rows = [] #to store grouped rows
-    current_row = [sorted_blocks[0]] ##we start the first row with the top most text block. each row needs at least one text block
-    current_row_y = sorted_blocks[0]['top'] #the vertical position of current row -- used to decide if other text blocks belong to the same row
-
+    order = np.argsort(tops, kind='mergesort')
+    row_ids = np.empty(len(tops), dtype=np.int64)
+    current_row = 0
+    previous_bucket = tops[order[0]] // threshold
+    for i in range(len(order)):
+        bucket = tops[order[i]] // threshold
+        if bucket != previous_bucket: #this block starts a new band -> a new row
+            current_row += 1
+            previous_bucket = bucket
+        row_ids[order[i]] = current_row
+    return row_ids
+
+if njit is not None:
+    #cache=True keeps the compiled code on disk so the jit cost is paid once,
+    #nogil=True lets the compiled loop run without holding the gil
+    _cluster_rows = njit(cache=True, nogil=True)(_cluster_rows)
+
+def group_text_into_rows(tops, bottoms):
     '''
-    Group text by rows
+    groups blocks into rows by vertical position -- the clustering itself
+    lives in _cluster_rows so numba can jit it.
+    the band width adapts to the document instead of being a hard-coded 5:
+    roughly 40% of the median text height. at 200 dpi the line pitch is
+    30-50 pixels and baselines jitter more than 5 pixels even within one row,
+    so a fixed 5 split real rows into several. set PDF2EXCEL_ROW_GAP to
+    override the heuristic when it guesses wrong for a document.
     '''
-    for block in sorted_blocks[1:]: #we skip first block as we have already added to the current block
-        y_difference = abs(block['top'] - current_row_y) #we see how far vertically this block is from the current row
-        
-        if y_difference <= 5: #if less than 10 pixels vertically, its the same row
-            current_row.append(block)
-        else:
-            rows.append(current_row)
-            current_row = [block] #starting a new row as this block as first item
-            current_row_y = block['top'] #updating the row position with refernce to new block vertical position
+    if len(tops) == 0:
+        return np.empty(0, dtype=np.int64)
+
+    override = os.environ.get('PDF2EXCEL_ROW_GAP')
+    if override is not None:
+        threshold = int(override)
+    else:
+        threshold = int(0.4 * np.median(bottoms - tops)) #40% of the typical text height tracks the document's dpi
+    return _cluster_rows(tops, max(threshold, 1)) #never below 1 pixel
 
-    rows.append(current_row)
-    return rows
-    
 #COLUMN DETECTION WITHIN ROWS
-def sort_row_into_columns(row_blocks):
+def sort_row_into_columns(lefts, row_indices):
     '''
     Within each row we arrange text from left to right to create proper columns
     '''
-    sorted_row = sorted(row_blocks, key=lambda x: x['left']) #sorting by horizontal position -- in natural column order
-    return sorted_row #returning row's text in proper left to right order
+    return row_indices[np.argsort(lefts[row_indices], kind='stable')] #sorting by horizontal position -- in natural column order
 
 #TABLE ORGANIZATION FUNCTION
-def organize_into_table(text_blocks):
+def organize_into_table(lefts, tops, rights, bottoms, texts):
     '''
     row grouping and column grouping creating final table structure
     '''
-    rows = group_text_into_rows(text_blocks)
+    row_ids = group_text_into_rows(tops, bottoms)
 
     organized_table = []
 
-    for row in rows:
-        sorted_row = sort_row_into_columns(row)
-        row_texts = [block['text'].strip() for block in sorted_row] #extract just the text content from each block and remove white spaces
+    for row_id in range(row_ids.max() + 1 if len(row_ids) else 0):
+        row_indices = np.where(row_ids == row_id)[0] #the blocks belonging to this row
+        sorted_row = sort_row_into_columns(lefts, row_indices)
+        row_texts = [texts[i].strip() for i in sorted_row] #extract just the text content from each block and remove white spaces
         organized_table.append(row_texts)
 
     return organized_table
 
 #EXCEL WRITING FUNCTION
 def write_table_to_excel(table_data, output_filename):
-    from openpyxl import workbook #workbook is the main class for creating excel files
-    wb = openpyxl.Workbook() #craeting a blank excel workbook programmatically
-    ws = wb.active #we get the active worksheet where we will write our table; not calling just referncing to the worksheet
+    '''
+    write-only mode streams each row to disk as it is appended instead of
+    keeping a Cell object per cell in memory -- for a big scan that's hundreds
+    of thousands of python objects we never create, and saving is much faster.
+    '''
+    wb = openpyxl.Workbook(write_only=True) #craeting a streaming excel workbook programmatically
+    ws = wb.create_sheet() #write-only workbooks start empty, so we create the worksheet ourselves
 
-    if table_data:
-        headers = table_data[0]
+    rows = iter(table_data) #works for lists and generators alike, and skips the [1:] slice that copied the whole table
+    headers = next(rows, None) #the first row is the header row (None when there are no rows at all)
 
-        #writing headers
-        for col_num, headers in enumerate(headers, 1): #gives both header text and column number starting from 1
-            cell = ws.cell(row=1, column=col_num) #getting specific cellin row 1 and current col number to write the header file here
-            cell.value = headers #setting cell's content to header text
-            cell.font = openpyxl.styles.Font(bold=True) #setting styles for header text
+    if headers is not None:
+        #writing headers -- write-only mode has no ws.cell(), so styled cells are built before appending
+        header_cells = []
+        for header in headers:
+            cell = WriteOnlyCell(ws, value=header)
+            cell.font = BOLD #setting styles for header text -- reusing the shared font instead of allocating one per cell
+            header_cells.append(cell)
+        ws.append(header_cells)
 
-        #writing data rows
-        for row_num, row_data in enumerate(table_data[1:], 2): #counting from second row -- skipping the first row for headers 
-            for col_num, cell_data in enumerate(row_data, 1): #for each data row -- iterate through each column value -- assign a column number starting from 1
-                cell = ws.cell(row=row_num, column=col_num)
-                cell.value = cell_data #setting cell's content to data value
+        #writing data rows -- whole rows at a time, nothing kept around after the append
+        for row_data in rows:
+            ws.append(row_data)
 
     wb.save(output_filename)
     print(f"Exceel file saved as: {output_filename}")
 
-def main(pdf_path):
+def main(pdf_path, dpi=DEFAULT_DPI):
     try:
-        images = convert_pdf_to_images(pdf_path)
-        print(f"Successfully converted PDF to {len(images)} images")
-
+        if not os.path.exists(pdf_path):
+            raise FileNotFoundError(f"PDF file not found: {pdf_path}")
+        doc = fitz.open(pdf_path) #only to count pages -- nothing is rendered here
+        page_count = doc.page_count
+        doc.close()
     except Exception as e: #Exception is the general error type
         print(f"Error processing PDF: {e}")
         return None #when error occures we exit the function early, returning None
 
     '''
-    "client" - basically opening a connection to google's servers
-    client will send our images and recieve back ocr results
+    fan the pages out across cpu cores. every worker process renders, uploads
+    and analyzes its own contiguous slice of pages -- separate processes mean
+    the jpeg encoding and proto parsing aren't serialized behind one gil.
+    we hand out contiguous slices (rather than single pages) so each worker
+    can still pack 16 pages into every api call.
     '''
-    client = vision.ImageAnnotatorClient() 
-    all_text_data = [] #this empty list will store text data from each page as we process them
+    workers = min(os.cpu_count() or 1, max(1, -(-page_count // BATCH_SIZE))) #no point spawning more workers than there are batches
+    slice_size = -(-page_count // workers) #ceiling division -- pages per worker
+    page_slices = [range(start, min(start + slice_size, page_count)) for start in range(0, page_count, slice_size)]
+
+    page_blocks = [] #per-page soa arrays -- concatenated into one set of arrays once every page is in
 
-    for i, image in enumerate(images): #enumerate gives both image and page no(i). 
-        print(f"Processing page {i+1}...")
-        page_data = extract_text_from_image(client, image)
-        all_text_data.append(page_data)
+    try:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker_client) as pool:
+            #map keeps results in submission order, so pages come back in page order
+            for blocks in pool.map(process_pages, [pdf_path] * len(page_slices), page_slices, [dpi] * len(page_slices)):
+                page_blocks.extend(blocks)
+    except Exception as e: #anything that went wrong inside a worker surfaces here
+        print(f"Error processing PDF: {e}")
+        return None
 
-    table_data = [] #this will store our final table data - organized into rows and columns
+    print(f"Successfully processed {page_count} pages")
 
-    for page_data in all_text_data:
-        structured_text = analyze_table_structure(page_data) #we process each page's ocr results through our analysis function
-        table_data.extend(structured_text) #adding all our structured text blocks into one collection
+    #stitch the per-page arrays into one set of arrays covering the whole document
+    if page_blocks:
+        lefts = np.concatenate([p[0] for p in page_blocks])
+        tops = np.concatenate([p[1] for p in page_blocks])
+        rights = np.concatenate([p[2] for p in page_blocks])
+        bottoms = np.concatenate([p[3] for p in page_blocks])
+        texts = [text for p in page_blocks for text in p[4]]
+    else:
+        lefts, tops, rights, bottoms, texts = empty_text_blocks()
 
-    oraganized_table = organize_into_table(table_data) #positioned text block into organization function to a structured table
+    oraganized_table = organize_into_table(lefts, tops, rights, bottoms, texts) #positioned text block into organization function to a structured table
     print(f"Organized table with {len(oraganized_table)} rows") #user feedback: how many rows were detected
     
     for i, row in enumerate(oraganized_table[:5]):
@@ -185,13 +367,15 @@ def main(pdf_path):
 
 
 if __name__=="__main__": #only run this code if someone executes this directly and not when imported as a module
-    if len(sys.argv) != 2: #sys.argv contains command line arguments; index 0:script name, index 1:pdf file path
-        print("Usage: python pdf_to_excel.py <path_to_pdf_file>") #if user didn't provide the right number of arguments 
+    if len(sys.argv) not in (2, 3): #sys.argv contains command line arguments; index 0:script name, index 1:pdf file path, optional index 2:render dpi
+        print("Usage: python pdf_to_excel.py <path_to_pdf_file> [dpi]") #if user didn't provide the right number of arguments
         print("Example: python pdf_to_excel.py my_document.pdf")
+        print("Example: python pdf_to_excel.py my_document.pdf 200  (higher dpi for very dense tables)")
 
         sys.exit()
 
     pdf_file_path = sys.argv[1] #we extract the PDF file path from command line arguments
+    render_dpi = int(sys.argv[2]) if len(sys.argv) == 3 else DEFAULT_DPI #optional override for dense tables
     print(f"Starting PDF to Excel conversion for: {pdf_file_path}")
 
-    main(pdf_file_path) #calling main function
\ No newline at end of file
+    main(pdf_file_path, render_dpi) #calling main function
\ No newline at end of file